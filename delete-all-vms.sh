@@ -1,5 +1,9 @@
 #!/bin/bash
 
+# master address from slave.py (install.sh sets it there), without the /register part
+script_dir="$(dirname "$0")"
+MASTER_BASE_URL=$(grep -oP '^MASTER_URL = "\K[^"]+' "$script_dir/slave.py" | sed 's|/register$||')
+
 # does what it does
 for vm in $(sudo virsh list --all --name); do
     echo "Processing VM: $vm"
@@ -32,6 +36,14 @@ for vm in $(sudo virsh list --all --name); do
     echo "Undefining VM: $vm"
     sudo virsh undefine "$vm" --nvram
 
+    # free its host ports so a new VM with the same name doesn't inherit its forwards
+    if [ -n "$MASTER_BASE_URL" ]; then
+        echo "Releasing port forwards of VM: $vm"
+        curl -s --max-time 10 -X POST "$MASTER_BASE_URL/release_ports" \
+            -H "Content-Type: application/json" \
+            -d "{\"vm_name\": \"$vm\"}" > /dev/null
+    fi
+
     echo "Completed processing VM: $vm"
 done
 
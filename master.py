@@ -1,7 +1,11 @@
 import requests
-from fastapi import FastAPI, HTTPException
+import asyncio
+import base64
+import json
+import os
+from fastapi import FastAPI, HTTPException, Query
 from pydantic import BaseModel
-from typing import List, Dict
+from typing import List, Dict, Optional
 from threading import Lock
 import httpx
 from typing import List, Tuple
@@ -9,6 +13,20 @@ from typing import List, Tuple
 app = FastAPI()
 lock = Lock()
 
+VM_LIST_DEFAULT_LIMIT = 100
+VM_LIST_MAX_LIMIT = 1000
+VM_RECORD_FIELDS = ["name", "state", "vcpus", "memory", "disk", "ip", "os", "node", "uptime"]
+
+# Host ports handed out to port forwards, tracked per node and kept on disk so
+# slaves can restore their forwards after a reboot.
+PORT_RANGE_START = 20000
+PORT_RANGE_END = 29999
+PORT_FORWARDS_FILE = "/home/pi/pi-server/port_forwards.json"
+
+# create_vm can wait in a slave's provisioning queue for a long time, but a node
+# that doesn't even accept the connection should be skipped quickly
+CREATE_VM_TIMEOUT = httpx.Timeout(3600, connect=5)
+
 # Models
 class VMRequest(BaseModel):
     name: str
@@ -16,6 +34,12 @@ class VMRequest(BaseModel):
     vcpus: int
     disk_size: int
     os: str
+    priority: int = 0
+    storage_tier: Optional[str] = None
+    disk_cache: Optional[str] = None
+    disk_io: Optional[str] = None
+    disk_iotune: Optional[Dict[str, int]] = None
+    port_forwards: Optional[List[int]] = None  # VM ports, host ports are allocated
 
 class NodeInfo(BaseModel):
     node_name: str
@@ -24,7 +48,12 @@ class NodeInfo(BaseModel):
 
 class PortForwardRequest(BaseModel):
     vm_name: str
-    port_mappings: List[Tuple[int, int]]
+    port_mappings: List[Tuple[int, int]] = []  # (host_port, target_port)
+    target_ports: List[int] = []  # VM ports that get a free host port allocated
+
+class ReleasePortsRequest(BaseModel):
+    vm_name: str
+    host_ports: List[int] = []  # all of the VM's ports if empty
 
 class ClusterStatus(BaseModel):
     status: Dict[str, dict]
@@ -32,6 +61,125 @@ class ClusterStatus(BaseModel):
 # keep track of registered slave nodes
 registered_nodes: List[Dict[str, str]] = []
 
+# MB of VMs this master has sent to a node and not heard back about, by node URL
+pending_memory: Dict[str, int] = {}
+
+def node_allocatable_memory(node_url: str, resources: dict) -> Optional[int]:
+    """Memory a density-mode node can still take, counting placements in flight.
+
+    The node already subtracts what it is provisioning, but a request we just
+    sent may not have reached it yet, so use whichever in-flight figure is larger.
+    """
+    allocatable = resources.get("allocatable_memory")
+    if allocatable is None:
+        return None
+    provisioning = resources.get("provisioning_memory", 0)
+    return allocatable + provisioning - max(provisioning, pending_memory.get(node_url, 0))
+
+def load_port_index() -> Dict[str, Dict[int, dict]]:
+    """Load the recorded port forwards, {node_name: {host_port: forward}}."""
+    if not os.path.exists(PORT_FORWARDS_FILE):
+        return {}
+    with open(PORT_FORWARDS_FILE) as f:
+        data = json.load(f)
+    # JSON object keys are strings
+    return {node: {int(port): forward for port, forward in ports.items()} for node, ports in data.items()}
+
+def save_port_index() -> None:
+    """Write the port index atomically so a crash never leaves half a file."""
+    tmp_path = f"{PORT_FORWARDS_FILE}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(port_index, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, PORT_FORWARDS_FILE)
+
+port_index = load_port_index()
+
+def allocate_ports(node_name: str, vm_name: str, port_mappings: List[Tuple[int, int]], target_ports: List[int]):
+    """Reserve host ports on a node for a VM, rejecting conflicts.
+
+    Returns all mappings for the request and the host ports newly reserved.
+    """
+    with lock:
+        used = port_index.setdefault(node_name, {})
+        mappings = []
+        for host_port, target_port in port_mappings:
+            # keeps forwards off the node's own ports (ssh, the slave API, ...)
+            if not PORT_RANGE_START <= host_port <= PORT_RANGE_END:
+                raise HTTPException(
+                    status_code=400,
+                    detail=f"Host port {host_port} is outside the forwardable range {PORT_RANGE_START}-{PORT_RANGE_END}."
+                )
+            existing = used.get(host_port)
+            if existing and (existing["vm_name"], existing["target_port"]) != (vm_name, target_port):
+                raise HTTPException(
+                    status_code=409,
+                    detail=f"Host port {host_port} on node {node_name} is already forwarded to {existing['vm_name']}:{existing['target_port']}."
+                )
+            mappings.append((host_port, target_port))
+        if len({host_port for host_port, _ in mappings}) != len(mappings):
+            raise HTTPException(status_code=409, detail="The same host port is requested more than once.")
+
+        taken = set(used) | {host_port for host_port, _ in mappings}
+        free_ports = (port for port in range(PORT_RANGE_START, PORT_RANGE_END + 1) if port not in taken)
+        for target_port in target_ports:
+            # asking again for a port the VM already has gives back the same host port
+            current = [port for port, forward in used.items() if forward == {"vm_name": vm_name, "target_port": target_port}]
+            host_port = current[0] if current else next(free_ports, None)
+            if host_port is None:
+                raise HTTPException(status_code=409, detail=f"No free host ports left on node {node_name}.")
+            mappings.append((host_port, target_port))
+
+        added = [host_port for host_port, _ in mappings if host_port not in used]
+        for host_port, target_port in mappings:
+            used[host_port] = {"vm_name": vm_name, "target_port": target_port}
+        save_port_index()
+    return mappings, added
+
+def release_ports(node_name: str, vm_name: str, host_ports: List[int]) -> List[int]:
+    """Free a VM's host ports on a node (all of them if none are given)."""
+    with lock:
+        used = port_index.get(node_name, {})
+        released = [
+            port for port, forward in used.items()
+            if forward["vm_name"] == vm_name and (not host_ports or port in host_ports)
+        ]
+        for port in released:
+            del used[port]
+        save_port_index()
+    return released
+
+def node_port_forwards(node_name: str) -> List[dict]:
+    """Recorded port forwards of one node as flat records."""
+    with lock:
+        return [
+            {"vm_name": forward["vm_name"], "host_port": port, "target_port": forward["target_port"]}
+            for port, forward in sorted(port_index.get(node_name, {}).items())
+        ]
+
+def node_name_for_url(node_url: str) -> str:
+    for node in registered_nodes:
+        if node["node_url"] == node_url:
+            return node["node_name"]
+    return node_url
+
+async def forward_ports(client: httpx.AsyncClient, node: Dict[str, str], vm_name: str,
+                        port_mappings: List[Tuple[int, int]], target_ports: List[int]) -> dict:
+    """Allocate host ports for a VM and have its node apply the forwards."""
+    mappings, added = allocate_ports(node["node_name"], vm_name, port_mappings, target_ports)
+    try:
+        response = await client.post(
+            f"{node['node_url']}/port_forward",
+            json={"vm_name": vm_name, "port_mappings": mappings},
+            timeout=10
+        )
+    except httpx.RequestError as e:
+        release_ports(node["node_name"], vm_name, added)
+        raise HTTPException(status_code=500, detail=f"Error communicating with node {node['node_url']}: {e}")
+    if response.status_code != 200:
+        release_ports(node["node_name"], vm_name, added)
+        raise HTTPException(status_code=500, detail=f"Failed to forward port: {response.text}")
+    return response.json()
+
 @app.post("/register")
 async def register_node(node_info: NodeInfo):
     """Handle the registration of new nodes."""
@@ -65,55 +213,158 @@ async def create_vm(vm_request: VMRequest):
     if not valid_nodes:
         raise HTTPException(status_code=500, detail="No active nodes available with sufficient resources.")
 
-    # Sort nodes by free memory and CPU count (descending order)
+    # Nodes whose provisioning queue is full would only answer 429
+    def queue_full(node):
+        return node[1].get("provisioning", {}).get("full", False)
+
+    # Nodes need a storage pool of the requested tier with room for the disk
+    def has_storage(node):
+        pools = node[1].get("storage", [])
+        if vm_request.storage_tier:
+            pools = [pool for pool in pools if pool.get("tier") == vm_request.storage_tier]
+        return any(pool.get("free_gb", 0) >= vm_request.disk_size for pool in pools)
+
+    # Nodes in density mode report how much memory can still be handed out safely
+    def has_memory(node):
+        allocatable = node_allocatable_memory(node[0], node[1].get("resources", {}))
+        return allocatable is None or allocatable >= vm_request.memory
+
+    valid_nodes = [node for node in valid_nodes if has_memory(node)]
+    if not valid_nodes:
+        raise HTTPException(status_code=507, detail="No node has enough allocatable memory for this VM.")
+
+    valid_nodes = [node for node in valid_nodes if has_storage(node)]
+    if not valid_nodes:
+        raise HTTPException(status_code=507, detail="No node has a storage pool with enough free space for this VM.")
+
+    open_nodes = [node for node in valid_nodes if not queue_full(node)]
+    if not open_nodes:
+        raise HTTPException(status_code=429, detail="All nodes are busy provisioning, try again later.")
+
+    # Sort nodes by provisioning backlog (ascending), then free (or allocatable) memory and CPU count (descending)
     def get_sort_key(node):
         node_data = node[1]
         resources = node_data.get("resources", {})
-        free_memory = resources.get("free_memory", 0)
+        provisioning = node_data.get("provisioning", {})
+        backlog = provisioning.get("queued", 0) + provisioning.get("active", 0)
+        allocatable = node_allocatable_memory(node[0], resources)
+        free_memory = allocatable if allocatable is not None else resources.get("free_memory", 0)
         cpu_count = resources.get("cpu_count", 0)
-        return (free_memory, cpu_count)
+        return (-backlog, free_memory, cpu_count)
 
-    valid_nodes.sort(key=get_sort_key, reverse=True)
-    best_node = valid_nodes[0][0]
+    open_nodes.sort(key=get_sort_key, reverse=True)
 
-    try:
-        async with httpx.AsyncClient() as client:
-            response = await client.post(f"{best_node}/create_vm", json=vm_request.dict(), timeout=120)
+    # try the next best node if one fills up its queue in the meantime
+    retry_after = None
+    connect_errors = []
+    async with httpx.AsyncClient() as client:
+        for node_url, node_status in open_nodes:
+            # other placements may have used up the node's memory while we waited
+            if not has_memory((node_url, node_status)):
+                continue
+            pending_memory[node_url] = pending_memory.get(node_url, 0) + vm_request.memory
+            try:
+                # the master allocates host ports for the forwards once the VM is up
+                payload = vm_request.dict(exclude={"port_forwards"})
+                response = await client.post(f"{node_url}/create_vm", json=payload, timeout=CREATE_VM_TIMEOUT)
+            except (httpx.ConnectError, httpx.ConnectTimeout) as e:
+                # the node never got the request, so another node can take it
+                connect_errors.append(f"{node_url}: {e}")
+                continue
+            except httpx.RequestError as e:
+                raise HTTPException(status_code=500, detail=f"Error communicating with node {node_url}: {e}")
+            finally:
+                pending_memory[node_url] -= vm_request.memory
             if response.status_code == 200:
-                return response.json()
-            else:
+                result = response.json()
+                if vm_request.port_forwards:
+                    node = {"node_name": node_name_for_url(node_url), "node_url": node_url}
+                    # the VM exists at this point, so a failed forward must not look like a failed create
+                    try:
+                        forwarded = await forward_ports(client, node, vm_request.name, [], vm_request.port_forwards)
+                        result["port_forwards"] = forwarded["port_mappings"]
+                    except HTTPException as e:
+                        result["port_forwards"] = []
+                        result["port_forward_error"] = e.detail
+                return result
+            if response.status_code != 429:
                 raise HTTPException(status_code=500, detail=f"Failed to create VM: {response.text}")
-    except httpx.RequestError as e:
-        raise HTTPException(status_code=500, detail=f"Error communicating with node {best_node}: {e}")
+            retry_after = response.headers.get("Retry-After", "60")
+
+    if connect_errors and retry_after is None:
+        raise HTTPException(status_code=500, detail=f"Error communicating with nodes: {'; '.join(connect_errors)}")
+    raise HTTPException(
+        status_code=429,
+        detail="All nodes are busy provisioning, try again later.",
+        headers={"Retry-After": retry_after or "60"}
+    )
 
 @app.post("/port_forward")
 async def port_forward(port_request: PortForwardRequest):
     """
-    Request port forwarding for a specific VM.
+    Request port forwarding for a specific VM, allocating free host ports on request.
     """
+    if not port_request.port_mappings and not port_request.target_ports:
+        raise HTTPException(status_code=400, detail="No ports to forward.")
+
+    node = await find_vm_node(port_request.vm_name)
+    if not node:
+        raise HTTPException(status_code=404, detail=f"VM {port_request.vm_name} not found in the cluster.")
+
     async with httpx.AsyncClient() as client:
-        for node in registered_nodes:
+        return await forward_ports(
+            client, node, port_request.vm_name, port_request.port_mappings, port_request.target_ports
+        )
+
+@app.get("/port_forwards")
+async def get_port_forwards(node: Optional[str] = None, vm_name: Optional[str] = None):
+    """List recorded port forwards, optionally for one node or VM."""
+    with lock:
+        node_names = [node] if node else sorted(port_index)
+    forwards = []
+    for node_name in node_names:
+        for forward in node_port_forwards(node_name):
+            if not vm_name or forward["vm_name"] == vm_name:
+                forwards.append(dict(forward, node=node_name))
+    return {"forwards": forwards}
+
+@app.post("/release_ports")
+async def release_vm_ports(release_request: ReleasePortsRequest):
+    """Remove a VM's port forwards and free their host ports.
+
+    Works from the port index, so ports of VMs that were already deleted can
+    still be released.
+    """
+    vm_name = release_request.vm_name
+    with lock:
+        node_names = [
+            node_name for node_name, ports in port_index.items()
+            if any(forward["vm_name"] == vm_name for forward in ports.values())
+        ]
+    if not node_names:
+        raise HTTPException(status_code=404, detail=f"No port forwards recorded for VM {vm_name}.")
+
+    released = {}
+    errors = {}
+    async with httpx.AsyncClient() as client:
+        for node_name in node_names:
+            released[node_name] = release_ports(node_name, vm_name, release_request.host_ports)
+            node = next((n for n in registered_nodes if n["node_name"] == node_name), None)
+            if not node:
+                # the node picks up the new records when it restores its forwards
+                continue
             try:
-                response = await client.get(f"{node['node_url']}/vms", timeout=5)
-                if response.status_code == 200:
-                    vms = response.json().get("vms", [])
-                    if port_request.vm_name in vms:
-                        forward_response = await client.post(
-                            f"{node['node_url']}/port_forward",
-                            json={"vm_name": port_request.vm_name, "port_mappings": port_request.port_mappings},
-                            timeout=3
-                        )
-                        if forward_response.status_code == 200:
-                            return forward_response.json()
-                        else:
-                            raise HTTPException(
-                                status_code=500,
-                                detail=f"Failed to forward port: {forward_response.text}"
-                            )
+                response = await client.post(
+                    f"{node['node_url']}/sync_port_forwards",
+                    json={"forwards": node_port_forwards(node_name)},
+                    timeout=10
+                )
+                if response.status_code != 200:
+                    errors[node_name] = f"Failed to remove port forwards: {response.text}"
             except httpx.RequestError as e:
-                continue
+                errors[node_name] = f"Error communicating with node {node['node_url']}: {e}"
 
-    raise HTTPException(status_code=404, detail=f"VM {port_request.vm_name} not found in the cluster.")
+    return {"message": f"Released host ports {released} of VM {vm_name}.", "released": released, "errors": errors}
 
 @app.get("/status", response_model=ClusterStatus)
 async def cluster_status():
@@ -177,30 +428,86 @@ async def find_vm_node(vm_name: str):
     """Find the node where the VM is located."""
     async with httpx.AsyncClient() as client:
         for node in registered_nodes:
-            response = await client.get(f"{node['node_url']}/vms", timeout=5)
-            if response.status_code == 200:
-                vms = response.json().get("vms", [])
-                if vm_name in vms:
-                    return node
+            try:
+                response = await client.get(f"{node['node_url']}/vms", params={"name": vm_name}, timeout=5)
+            except httpx.RequestError:
+                continue
+            if response.status_code == 200 and response.json().get("vms"):
+                return node
     return None
 
-@app.get("/list_vms")
-async def list_all_vms():
-    """List all virtual machines across the cluster and their respective nodes."""
-    vms_on_nodes = {}
+def encode_cursor(node_name: str, vm_name: str) -> str:
+    return base64.urlsafe_b64encode(json.dumps([node_name, vm_name]).encode()).decode()
 
-    async with httpx.AsyncClient() as client:
-        for node in registered_nodes:
-            node_name = node.get("node_name", "unknown")
-            node_url = node.get("node_url", "unknown")
-            try:
-                response = await client.get(f"{node_url}/vms", timeout=5)
-                response.raise_for_status()
-                vms = response.json().get("vms", [])
-                vms_on_nodes[node_name] = vms
-            except httpx.RequestError as e:
-                vms_on_nodes[node_name] = f"Error: {str(e)}"
-            except Exception as e:
-                vms_on_nodes[node_name] = f"Unexpected error: {str(e)}"
+def decode_cursor(cursor: str) -> Tuple[str, str]:
+    try:
+        node_name, vm_name = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return node_name, vm_name
+    except (TypeError, ValueError):
+        raise HTTPException(status_code=400, detail="Invalid cursor.")
+
+async def fetch_node_vms(client: httpx.AsyncClient, node_url: str, params: dict) -> List[dict]:
+    """Fetch every VM record from one node, following its cursor."""
+    vms = []
+    params = dict(params, limit=VM_LIST_MAX_LIMIT)
+    while True:
+        response = await client.get(f"{node_url}/vms", params=params, timeout=10)
+        response.raise_for_status()
+        data = response.json()
+        vms.extend(data.get("vms", []))
+        if not data.get("next_cursor"):
+            return vms
+        params["cursor"] = data["next_cursor"]
 
-    return {"vms_on_nodes": vms_on_nodes}
+@app.get("/list_vms")
+async def list_all_vms(
+    state: Optional[str] = None,
+    os_name: Optional[str] = Query(None, alias="os"),
+    node: Optional[str] = None,
+    cursor: Optional[str] = None,
+    limit: int = Query(VM_LIST_DEFAULT_LIMIT, ge=1, le=VM_LIST_MAX_LIMIT),
+    compact: bool = False
+):
+    """List virtual machines across the cluster with state and resources."""
+    nodes = [n for n in registered_nodes if not node or n.get("node_name") == node]
+    params = {}
+    if state:
+        params["state"] = state
+    if os_name:
+        params["os"] = os_name
+
+    # one inventory query per node, all nodes at once
+    async with httpx.AsyncClient() as client:
+        results = await asyncio.gather(
+            *(fetch_node_vms(client, n["node_url"], params) for n in nodes),
+            return_exceptions=True
+        )
+
+    vms = []
+    errors = {}
+    for n, result in zip(nodes, results):
+        node_name = n.get("node_name", "unknown")
+        if isinstance(result, httpx.RequestError):
+            errors[node_name] = f"Error: {str(result)}"
+        elif isinstance(result, Exception):
+            errors[node_name] = f"Unexpected error: {str(result)}"
+        else:
+            # the master knows nodes by their registered name
+            vms.extend(dict(vm, node=node_name) for vm in result)
+
+    vms.sort(key=lambda vm: (vm["node"], vm["name"]))
+    if cursor:
+        after = decode_cursor(cursor)
+        vms = [vm for vm in vms if (vm["node"], vm["name"]) > after]
+
+    page = vms[:limit]
+    next_cursor = encode_cursor(page[-1]["node"], page[-1]["name"]) if len(vms) > limit else None
+
+    if compact:
+        return {
+            "fields": VM_RECORD_FIELDS,
+            "rows": [[vm.get(field) for field in VM_RECORD_FIELDS] for vm in page],
+            "next_cursor": next_cursor,
+            "errors": errors
+        }
+    return {"vms": page, "next_cursor": next_cursor, "errors": errors}
@@ -1,11 +1,18 @@
 import os
 import shutil
 import subprocess
-from fastapi import FastAPI, HTTPException
+import asyncio
+import heapq
+import base64
+import re
+import itertools
+import threading
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, HTTPException, Query
 from pydantic import BaseModel
 import requests
 import time
-from typing import List, Optional
+from typing import Dict, List, Optional
 import logging
 import socket
 from typing import Tuple
@@ -35,12 +42,72 @@ logger.addHandler(console_handler)
 DISK_FOLDER = "/home/pi/pi-server/disks"
 VM_DISKS_FOLDER = "/home/pi/pi-server/vms"
 MASTER_URL = "http://pi1.local:8000/register"
+# install.sh only rewrites the MASTER_URL line, so derive the rest from it
+MASTER_BASE_URL = MASTER_URL.rsplit("/register", 1)[0]
 OS_IMAGES = {
     "alpine": "alpine.qcow2",
     "ubuntu": "ubuntu.qcow2",
     "debian": "debian.qcow2",
 }
 
+# Provisioning admission control. Copying images and running virt-install in
+# parallel on one SD card makes everything time out, so slots are limited by
+# measured disk throughput and free memory and the rest wait in a queue.
+PROVISION_MAX_CONCURRENCY = 4
+PROVISION_MAX_QUEUE = 8
+PROVISION_MBPS_PER_SLOT = 40  # disk throughput one image copy needs to not crawl
+PROVISION_MEMORY_PER_SLOT = 1024  # MB of free memory kept per running provision
+PROVISION_DEFAULT_DURATION = 30  # seconds, used for Retry-After before we have samples
+VM_BOOT_WAIT = 60  # seconds a new VM gets to boot before we look up its IP
+DISK_BENCHMARK_SIZE = 32  # MB written when measuring disk throughput
+
+# Storage pools VM disks can be placed on. Pools whose folder does not exist
+# (e.g. no NVMe HAT fitted) are ignored, so the SD card pool always works.
+STORAGE_POOLS = {
+    "sd": {"path": VM_DISKS_FOLDER, "tier": "standard"},
+    "nvme": {"path": "/mnt/nvme/pi-server/vms", "tier": "fast"},
+}
+DISK_CACHE_MODES = ["default", "none", "writethrough", "writeback", "directsync", "unsafe"]
+DISK_IO_MODES = ["native", "threads", "io_uring"]
+DISK_IOTUNE_KEYS = [
+    "total_bytes_sec", "read_bytes_sec", "write_bytes_sec",
+    "total_iops_sec", "read_iops_sec", "write_iops_sec",
+]
+
+# VM listing
+VM_LIST_DEFAULT_LIMIT = 100
+VM_LIST_MAX_LIMIT = 1000
+VM_RECORD_FIELDS = ["name", "state", "vcpus", "memory", "disk", "ip", "os", "node", "uptime"]
+DOMAIN_STATES = {
+    0: "nostate",
+    1: "running",
+    2: "blocked",
+    3: "paused",
+    4: "shutdown",
+    5: "shutoff",
+    6: "crashed",
+    7: "pmsuspended",
+}
+QEMU_GUEST_NAME = re.compile(r"-name guest=([^,\s]+)")
+
+# Port forwards live in our own iptables chains so they can be rewritten in one
+# iptables-restore call instead of appending (and duplicating) rules one by one.
+PORT_FORWARD_NAT_CHAIN = "PISERVER-DNAT"
+PORT_FORWARD_FILTER_CHAIN = "PISERVER-FWD"
+PORT_FORWARD_RECONCILE_INTERVAL = 30  # seconds between VM IP change checks
+
+# Density mode: shrink the balloons of idle guests and count KSM sharing so the
+# master can place more VMs than the sum of their configured memory allows.
+DENSITY_MODE = False
+DENSITY_INTERVAL = 60  # seconds between balloon adjustments
+DENSITY_IDLE_CPU = 0.05  # share of its vCPUs below which a guest counts as idle
+DENSITY_BALLOON_FLOOR = 256  # MB, never balloon a guest below this
+DENSITY_BALLOON_FLOOR_RATIO = 0.5  # nor below this share of its configured memory
+DENSITY_BALLOON_HEADROOM = 0.25  # extra memory left on top of what an idle guest uses
+DENSITY_BALLOON_STEP = 256  # MB a balloon may shrink per adjustment
+DENSITY_HOST_RESERVED = 512  # MB kept for the host itself
+DENSITY_MAX_OVERCOMMIT = 1.5  # configured guest memory may reach this times host memory
+
 # Start FastAPI stuff
 app = FastAPI()
 
@@ -50,7 +117,12 @@ class VMRequest(BaseModel):
     vcpus: int
     disk_size: int
     os: str
-    port_forwards: Optional[List[int]] = None
+    port_forwards: Optional[List[int]] = None  # rejected, forwards go through the master's /port_forward
+    priority: int = 0  # higher runs first when provisioning is queued
+    storage_tier: Optional[str] = None  # e.g. "fast" for NVMe, any pool if not set
+    disk_cache: Optional[str] = None  # one of DISK_CACHE_MODES
+    disk_io: Optional[str] = None  # one of DISK_IO_MODES
+    disk_iotune: Optional[Dict[str, int]] = None  # DISK_IOTUNE_KEYS -> limit
 
 
 
@@ -61,6 +133,14 @@ class PortForwardRequest(BaseModel):
 class VMNameRequest(BaseModel):
     vm_name: str
 
+class PortForwardRecord(BaseModel):
+    vm_name: str
+    host_port: int
+    target_port: int
+
+class PortForwardSyncRequest(BaseModel):
+    forwards: List[PortForwardRecord]
+
 
 
 def get_system_resources():
@@ -74,6 +154,219 @@ def get_system_resources():
         logger.error(f"Error fetching system resources: {e}")
         raise
 
+def get_available_memory() -> Optional[int]:
+    """MemAvailable in MB, unlike free_memory it counts page cache that can be reclaimed."""
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) // 1024  # kB -> MB
+    except (OSError, ValueError) as e:
+        logger.error(f"Error reading available memory: {e}")
+    return None
+
+def measure_disk_throughput(path: str, size_mb: int = DISK_BENCHMARK_SIZE) -> Optional[float]:
+    """Measure sequential write throughput of the disk holding path in MB/s."""
+    test_file = os.path.join(path, ".throughput-test")
+    chunk = os.urandom(1024 * 1024)
+    try:
+        os.makedirs(path, exist_ok=True)
+        started = time.monotonic()
+        with open(test_file, "wb") as f:
+            for _ in range(size_mb):
+                f.write(chunk)
+            f.flush()
+            os.fsync(f.fileno())
+        elapsed = time.monotonic() - started
+        return size_mb / elapsed if elapsed > 0 else None
+    except OSError as e:
+        logger.error(f"Error measuring disk throughput for {path}: {e}")
+        return None
+    finally:
+        if os.path.exists(test_file):
+            os.remove(test_file)
+
+# MAC addresses never change for a defined VM so look them up only once
+vm_mac_cache: Dict[str, str] = {}
+
+# measured write throughput per storage pool in MB/s, filled in at startup
+storage_pool_mbps: Dict[str, Optional[float]] = {}
+
+# GB promised to disks still being provisioned, per storage pool
+storage_pool_reserved: Dict[str, int] = {}
+storage_pool_lock = threading.Lock()
+
+def get_storage_pools() -> List[dict]:
+    """List the usable storage pools with their capacity and throughput."""
+    pools = []
+    for name, pool in STORAGE_POOLS.items():
+        if not os.path.isdir(pool["path"]):
+            continue
+        try:
+            usage = shutil.disk_usage(pool["path"])
+        except OSError as e:
+            logger.error(f"Error reading usage of storage pool {name}: {e}")
+            continue
+        mbps = storage_pool_mbps.get(name)
+        reserved = storage_pool_reserved.get(name, 0)
+        pools.append({
+            "name": name,
+            "path": pool["path"],
+            "tier": pool["tier"],
+            "total_gb": round(usage.total / 1024 ** 3, 1),
+            "used_gb": round(usage.used / 1024 ** 3, 1),
+            # disks being provisioned will grow into this space, so it isn't really free
+            "free_gb": max(0.0, round(usage.free / 1024 ** 3 - reserved, 1)),
+            "reserved_gb": reserved,
+            "mbps": round(mbps, 1) if mbps else None,
+        })
+    return pools
+
+def select_storage_pool(disk_size: int, tier: Optional[str] = None) -> dict:
+    """Pick the pool for a new VM disk: right tier, enough room, fastest first."""
+    pools = get_storage_pools()
+    if tier:
+        pools = [pool for pool in pools if pool["tier"] == tier]
+        if not pools:
+            raise HTTPException(status_code=400, detail=f"No storage pool with tier '{tier}' on this node.")
+    pools = [pool for pool in pools if pool["free_gb"] >= disk_size]
+    if not pools:
+        raise HTTPException(status_code=507, detail=f"No storage pool has {disk_size}GB free.")
+    pools.sort(key=lambda pool: (pool["mbps"] or 0, pool["free_gb"]), reverse=True)
+    return pools[0]
+
+def reserve_storage_pool(disk_size: int, tier: Optional[str] = None) -> dict:
+    """Pick a pool and hold disk_size GB of it until release_storage_pool."""
+    with storage_pool_lock:
+        pool = select_storage_pool(disk_size, tier)
+        storage_pool_reserved[pool["name"]] = storage_pool_reserved.get(pool["name"], 0) + disk_size
+    return pool
+
+def release_storage_pool(pool: dict, disk_size: int) -> None:
+    with storage_pool_lock:
+        storage_pool_reserved[pool["name"]] -= disk_size
+
+def validate_disk_options(vm_request: VMRequest) -> None:
+    """Reject disk cache/io/iotune settings libvirt would refuse."""
+    if vm_request.disk_cache and vm_request.disk_cache not in DISK_CACHE_MODES:
+        raise HTTPException(status_code=400, detail=f"Unsupported disk cache mode: {vm_request.disk_cache}")
+    if vm_request.disk_io and vm_request.disk_io not in DISK_IO_MODES:
+        raise HTTPException(status_code=400, detail=f"Unsupported disk io mode: {vm_request.disk_io}")
+    # native AIO only works when the host page cache is bypassed
+    if vm_request.disk_io == "native" and vm_request.disk_cache not in ("none", "directsync"):
+        raise HTTPException(status_code=400, detail="Disk io mode 'native' needs disk cache 'none' or 'directsync'.")
+    for key, value in (vm_request.disk_iotune or {}).items():
+        if key not in DISK_IOTUNE_KEYS:
+            raise HTTPException(status_code=400, detail=f"Unsupported disk iotune setting: {key}")
+        if value < 0:
+            raise HTTPException(status_code=400, detail=f"Disk iotune setting {key} must not be negative.")
+    # libvirt refuses a total_* limit together with a read_*/write_* limit of the same kind
+    iotune = vm_request.disk_iotune or {}
+    for kind in ("bytes_sec", "iops_sec"):
+        if f"total_{kind}" in iotune and (f"read_{kind}" in iotune or f"write_{kind}" in iotune):
+            raise HTTPException(
+                status_code=400,
+                detail=f"Disk iotune total_{kind} can't be combined with read_{kind}/write_{kind}."
+            )
+
+def build_disk_arg(disk_path: str, vm_request: VMRequest) -> str:
+    """Build the virt-install --disk value including cache, io and throttling."""
+    options = [f"path={disk_path}", f"size={vm_request.disk_size}"]
+    if vm_request.disk_cache:
+        options.append(f"cache={vm_request.disk_cache}")
+    if vm_request.disk_io:
+        options.append(f"io={vm_request.disk_io}")
+    for key, value in (vm_request.disk_iotune or {}).items():
+        options.append(f"iotune.{key}={value}")
+    return ",".join(options)
+
+class ProvisionQueue:
+    """Bounded priority queue that admits VM provisioning a few at a time."""
+
+    def __init__(self, max_queue: int = PROVISION_MAX_QUEUE):
+        self.max_queue = max_queue
+        self.active = 0
+        self.disk_mbps: Optional[float] = None
+        self.avg_duration = float(PROVISION_DEFAULT_DURATION)
+        self._waiters = []  # heap of (-priority, seq, future)
+        self._seq = itertools.count()
+
+    def depth(self) -> int:
+        """Number of provisioning requests waiting for a slot."""
+        return sum(1 for _, _, fut in self._waiters if not fut.done())
+
+    def max_concurrency(self) -> int:
+        """Slots allowed right now based on disk throughput and free memory."""
+        if self.disk_mbps is None:
+            disk_slots = 1
+        else:
+            disk_slots = int(self.disk_mbps // PROVISION_MBPS_PER_SLOT)
+        available_memory = get_available_memory()
+        memory_slots = available_memory // PROVISION_MEMORY_PER_SLOT if available_memory is not None else 1
+        return max(1, min(PROVISION_MAX_CONCURRENCY, disk_slots, memory_slots))
+
+    def retry_after(self) -> int:
+        """Seconds until a queue spot is likely to free up."""
+        waves = (self.depth() + self.active) / self.max_concurrency()
+        return max(1, int(self.avg_duration * waves))
+
+    def is_full(self) -> bool:
+        return self.depth() >= self.max_queue
+
+    def stats(self) -> dict:
+        return {
+            "active": self.active,
+            "queued": self.depth(),
+            "max_concurrency": self.max_concurrency(),
+            "max_queue": self.max_queue,
+            "full": self.is_full(),
+            "disk_mbps": round(self.disk_mbps, 1) if self.disk_mbps else None,
+            "avg_duration": round(self.avg_duration, 1),
+        }
+
+    @asynccontextmanager
+    async def slot(self, priority: int = 0):
+        """Wait for a provisioning slot, or raise 429 when the queue is full."""
+        if self.depth() == 0 and self.active < self.max_concurrency():
+            self.active += 1
+        else:
+            if self.is_full():
+                raise HTTPException(
+                    status_code=429,
+                    detail="Provisioning queue is full, try again later or use another node.",
+                    headers={"Retry-After": str(self.retry_after())}
+                )
+            fut = asyncio.get_running_loop().create_future()
+            heapq.heappush(self._waiters, (-priority, next(self._seq), fut))
+            try:
+                await fut
+            except asyncio.CancelledError:
+                # we were handed a slot just before being cancelled, give it back
+                if fut.done() and not fut.cancelled():
+                    self._release()
+                raise
+
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.avg_duration = 0.8 * self.avg_duration + 0.2 * (time.monotonic() - started)
+            self._release()
+
+    def _release(self):
+        self.active -= 1
+        while self._waiters and self.active < self.max_concurrency():
+            _, _, fut = heapq.heappop(self._waiters)
+            if fut.done():
+                continue  # cancelled while waiting
+            self.active += 1
+            fut.set_result(None)
+
+provision_queue = ProvisionQueue()
+
+# requests admitted but not finished yet (queued or running), by VM name
+provisioning_vms: Dict[str, "VMRequest"] = {}
+
 def vm_exists(name: str) -> bool:
     """Check if a VM with the given name exists."""
     try:
@@ -90,86 +383,479 @@ def vm_exists(name: str) -> bool:
         logger.error(f"Error checking VM existence: {e}")
         return False
 
+def get_vm_mac(vm_name: str) -> Optional[str]:
+    """Retrieve the MAC address of a VM's first interface, cached per VM."""
+    if vm_name in vm_mac_cache:
+        return vm_mac_cache[vm_name]
+
+    result = subprocess.run(
+        ["sudo", "virsh", "domiflist", vm_name],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        text=True
+    )
+    if result.returncode != 0:
+        logger.error(f"Error getting VM details: {result.stderr.strip()}")
+        return None
+
+    for line in result.stdout.splitlines():
+        columns = line.split()
+        if len(columns) >= 5 and columns[0] != "Interface":
+            mac_address = columns[4]  # The MAC address is in the flippin 5th column!!!!!
+            vm_mac_cache[vm_name] = mac_address
+            logger.info(f"MAC address for VM '{vm_name}' is {mac_address}")
+            return mac_address
+
+    logger.error(f"Failed to retrieve MAC address for VM: {vm_name}")
+    return None
+
+def get_arp_table() -> Dict[str, str]:
+    """Map lower-case MAC addresses to IPs from the host ARP table."""
+    # thanks god i found this!!!!!!!
+    result = subprocess.run(
+        ["sudo", "arp", "-n"],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        text=True
+    )
+    if result.returncode != 0:
+        logger.error(f"Error fetching ARP table: {result.stderr.strip()}")
+        return {}
+
+    arp_table = {}
+    for line in result.stdout.splitlines():
+        columns = line.split()
+        if len(columns) >= 3:
+            arp_table[columns[2].lower()] = columns[0]  # IP address should be in the first column i think maybe
+    return arp_table
+
 def get_vm_ip(vm_name: str) -> Optional[str]:
     """Retrieve the IP address of a running VM using ARP."""
     try:
+        mac_address = get_vm_mac(vm_name)
+        if not mac_address:
+            return None
+
+        #get my ippppppppp
+        vm_ip = get_arp_table().get(mac_address.lower())
+        if vm_ip:
+            logger.info(f"IP address for VM '{vm_name}' is {vm_ip}")
+            return vm_ip
+
+        logger.error(f"Failed to find IP address for MAC: {mac_address}")
+        return None
+    except Exception as e:
+        logger.error(f"Exception while retrieving VM IP by ARP: {e}")
+        return None
+
+def parse_domstats(output: str) -> Dict[str, Dict[str, str]]:
+    """Parse `virsh domstats` output into {domain: {stat: value}}."""
+    stats: Dict[str, Dict[str, str]] = {}
+    current = None
+    for line in output.splitlines():
+        line = line.strip()
+        if line.startswith("Domain:"):
+            current = stats.setdefault(line.split(":", 1)[1].strip().strip("'"), {})
+        elif current is not None and "=" in line:
+            key, value = line.split("=", 1)
+            current[key] = value
+    return stats
+
+def get_vm_uptimes() -> Dict[str, int]:
+    """Seconds each running VM's QEMU process has been up, from one ps call."""
+    result = subprocess.run(
+        ["ps", "-eo", "etimes=,args="],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        text=True
+    )
+    uptimes = {}
+    for line in result.stdout.splitlines():
+        columns = line.split(None, 1)
+        if len(columns) < 2 or not columns[0].isdigit():
+            continue
+        match = QEMU_GUEST_NAME.search(columns[1])
+        if match:
+            uptimes[match.group(1)] = int(columns[0])
+    return uptimes
+
+def get_vm_inventory(vm_name: Optional[str] = None) -> List[dict]:
+    """Describe every VM on this node (or just vm_name) using one batched domstats query."""
+    # a single-VM lookup only asks libvirt about that domain
+    domains_arg = [vm_name] if vm_name else ["--list-all"]
+    result = subprocess.run(
+        ["sudo", "virsh", "domstats", *domains_arg, "--state", "--vcpu", "--balloon", "--block"],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        text=True
+    )
+    if result.returncode != 0 and vm_name and "failed to get domain" in result.stderr.lower():
+        return []
+    if result.returncode != 0:
+        raise HTTPException(status_code=500, detail=f"Failed to fetch VM inventory: {result.stderr.strip()}")
+
+    domains = parse_domstats(result.stdout)
+    running = [name for name, stats in domains.items() if stats.get("state.state") == "1"]
+    arp_table = get_arp_table() if running else {}
+    uptimes = get_vm_uptimes() if running else {}
+    image_os = {image: os_name for os_name, image in OS_IMAGES.items()}
+    node_name = os.uname().nodename
+
+    vms = []
+    for name, stats in sorted(domains.items()):
+        state = DOMAIN_STATES.get(int(stats.get("state.state", 0)), "unknown")
+        memory = stats.get("balloon.maximum")
+        disk = stats.get("block.0.capacity")
+        disk_path = stats.get("block.0.path", "")
+        vm_ip = None
+        if name in running:
+            mac_address = get_vm_mac(name)
+            vm_ip = arp_table.get(mac_address.lower()) if mac_address else None
+        vms.append({
+            "name": name,
+            "state": state,
+            "vcpus": int(stats.get("vcpu.maximum", stats.get("vcpu.current", 0))),
+            "memory": int(memory) // 1024 if memory else None,  # KiB -> MB
+            "disk": round(int(disk) / 1024 ** 3, 1) if disk else None,  # bytes -> GB
+            "ip": vm_ip,
+            "os": image_os.get(os.path.basename(disk_path)),
+            "node": node_name,
+            "uptime": uptimes.get(name),
+        })
+    return vms
+
+class VirshStatsSource:
+    """Balloon and KSM statistics from libvirt and sysfs.
+
+    DensityManager only talks to this interface, so a fake with the same three
+    methods can stand in for it.
+    """
+
+    def __init__(self):
+        self._stats_enabled = set()
+
+    def read_domains(self) -> Dict[str, dict]:
+        """Per-domain state, vCPUs, CPU time (ns) and balloon sizes (MB)."""
         result = subprocess.run(
-            ["sudo", "virsh", "domiflist", vm_name],
+            ["sudo", "virsh", "domstats", "--list-all", "--state", "--vcpu", "--cpu-total", "--balloon"],
             stdout=subprocess.PIPE,
             stderr=subprocess.PIPE,
             text=True
         )
         if result.returncode != 0:
-            logger.error(f"Error getting VM details: {result.stderr.strip()}")
-            return None
+            raise RuntimeError(f"Failed to fetch domain stats: {result.stderr.strip()}")
 
-        mac_address = None
-        for line in result.stdout.splitlines():
-            columns = line.split()
-            if len(columns) >= 5 and columns[0] != "Interface":
-                mac_address = columns[4]  # The MAC address is in the flippin 5th column!!!!!
-                break
+        domains = {}
+        all_stats = parse_domstats(result.stdout)
+        self._stats_enabled &= set(all_stats)  # undefined domains
+        for name, stats in all_stats.items():
+            state = DOMAIN_STATES.get(int(stats.get("state.state", 0)), "unknown")
+            if state != "running":
+                # the stats period is lost when the guest stops, set it again on its next start
+                self._stats_enabled.discard(name)
+            elif "balloon.unused" not in stats:
+                self._enable_stats(name)
 
-        if not mac_address:
-            logger.error(f"Failed to retrieve MAC address for VM: {vm_name}")
-            return None
+            def mb(key):
+                return int(stats[key]) // 1024 if key in stats else None  # KiB -> MB
 
-        logger.info(f"MAC address for VM '{vm_name}' is {mac_address}")
+            domains[name] = {
+                "state": state,
+                "vcpus": int(stats.get("vcpu.current", 1)),
+                "cpu_time": int(stats.get("cpu.time", 0)),
+                "maximum": mb("balloon.maximum"),
+                "current": mb("balloon.current"),
+                "unused": mb("balloon.unused"),
+                "available": mb("balloon.available"),
+            }
+        return domains
 
-        # thanks god i found this!!!!!!!
-        result = subprocess.run(
-            ["sudo", "arp", "-n"],
-            stdout=subprocess.PIPE,
+    def read_ksm(self) -> dict:
+        """Host KSM counters, pages_sharing is the number of pages saved."""
+        ksm = {}
+        for counter in ("run", "pages_shared", "pages_sharing"):
+            try:
+                with open(f"/sys/kernel/mm/ksm/{counter}") as f:
+                    ksm[counter] = int(f.read().strip())
+            except (OSError, ValueError):
+                ksm[counter] = 0
+        ksm["page_size"] = os.sysconf("SC_PAGE_SIZE")
+        return ksm
+
+    def set_balloon(self, vm_name: str, memory: int) -> None:
+        """Set a running guest's balloon target in MB."""
+        subprocess.run(
+            ["sudo", "virsh", "setmem", vm_name, f"{memory}M", "--live"],
+            check=True,
             stderr=subprocess.PIPE,
             text=True
         )
 
-        if result.returncode != 0:
-            logger.error(f"Error fetching ARP table: {result.stderr.strip()}")
+    def _enable_stats(self, vm_name: str) -> None:
+        # the guest only reports unused/available memory once a period is set
+        if vm_name in self._stats_enabled:
+            return
+        subprocess.run(
+            ["sudo", "virsh", "dommemstat", vm_name, "--period", "10", "--live"],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL
+        )
+        self._stats_enabled.add(vm_name)
+
+class DensityManager:
+    """Adjust balloons of idle guests and work out effectively committed memory."""
+
+    def __init__(self, stats_source):
+        self.stats_source = stats_source
+        self.summary: dict = {}
+        self._last_cpu: Dict[str, Tuple[int, float]] = {}  # name -> (cpu_time, monotonic)
+        self._lock = threading.Lock()  # steps run from the loop and after each provision
+
+    def is_idle(self, vm_name: str, domain: dict, now: float) -> bool:
+        """Whether the guest used less than DENSITY_IDLE_CPU of its vCPUs since the last step."""
+        previous = self._last_cpu.get(vm_name)
+        self._last_cpu[vm_name] = (domain["cpu_time"], now)
+        if previous is None or now <= previous[1]:
+            return False
+        used = (domain["cpu_time"] - previous[0]) / 1e9
+        return used / ((now - previous[1]) * max(domain["vcpus"], 1)) < DENSITY_IDLE_CPU
+
+    def balloon_target(self, domain: dict, idle: bool) -> Optional[int]:
+        """Balloon size in MB the guest should have, None to leave it alone."""
+        maximum, current = domain["maximum"], domain["current"]
+        if not maximum or not current:
             return None
+        if not idle or domain["unused"] is None or domain["available"] is None:
+            # busy or no stats, give the guest all its memory back
+            return maximum if current < maximum else None
 
-        #get my ippppppppp
-        for line in result.stdout.splitlines():
-            columns = line.split()
-            if len(columns) >= 3 and mac_address.lower() == columns[2].lower():
-                logger.info(f"IP address for VM '{vm_name}' is {columns[0]}")
-                return columns[0]  # IP address should be in the first column i think maybe
+        floor = max(DENSITY_BALLOON_FLOOR, int(maximum * DENSITY_BALLOON_FLOOR_RATIO))
+        used = domain["available"] - domain["unused"]
+        target = max(floor, int(used * (1 + DENSITY_BALLOON_HEADROOM)))
+        # shrink in steps so the guest has time to give pages back
+        target = min(maximum, max(target, current - DENSITY_BALLOON_STEP))
+        return target if target != current else None
 
-        logger.error(f"Failed to find IP address for MAC: {mac_address}")
-        return None
-    except Exception as e:
-        logger.error(f"Exception while retrieving VM IP by ARP: {e}")
-        return None
+    def step(self, total_memory: int) -> dict:
+        """Run one adjustment pass and return the memory summary for the master."""
+        with self._lock:
+            return self._step(total_memory)
+
+    def _step(self, total_memory: int) -> dict:
+        domains = self.stats_source.read_domains()
+        ksm = self.stats_source.read_ksm()
+        now = time.monotonic()
 
+        running = {name: domain for name, domain in domains.items() if domain["state"] == "running"}
+        for vm_name in list(self._last_cpu):
+            if vm_name not in running:
+                del self._last_cpu[vm_name]
 
-def setup_port_forwarding(vm_ip: str, port_mappings: List[Tuple[int, int]]) -> None:
-    """Sets up port forwarding for a given VM IP and port mappings."""
+        for vm_name, domain in running.items():
+            target = self.balloon_target(domain, self.is_idle(vm_name, domain, now))
+            if target is None:
+                continue
+            try:
+                self.stats_source.set_balloon(vm_name, target)
+                logger.info(f"Balloon of VM '{vm_name}' set from {domain['current']}MB to {target}MB")
+                domain["current"] = target
+            except subprocess.CalledProcessError as e:
+                logger.error(f"Failed to set balloon of VM '{vm_name}': {e.stderr}")
+
+        ksm_saved = ksm["pages_sharing"] * ksm["page_size"] // (1024 ** 2)
+        # stopped VMs can be started at full size at any time (start_vm checks no memory),
+        # so they count against the overcommit limit too
+        committed = sum(domain["maximum"] or domain["current"] or 0 for domain in domains.values())
+        stopped = committed - sum(domain["maximum"] or domain["current"] or 0 for domain in running.values())
+        ballooned = sum(domain["current"] or 0 for domain in running.values())
+        effective_committed = max(0, ballooned - ksm_saved)
+        allocatable = min(
+            total_memory - DENSITY_HOST_RESERVED - effective_committed,
+            int(total_memory * DENSITY_MAX_OVERCOMMIT) - committed
+        )
+        self.summary = {
+            "running_vms": len(running),
+            "committed_memory": committed,
+            "stopped_memory": stopped,
+            "ballooned_memory": ballooned,
+            "ksm_saved_memory": ksm_saved,
+            "effective_committed_memory": effective_committed,
+            "allocatable_memory": max(0, allocatable),
+        }
+        return self.summary
+
+density_manager = DensityManager(VirshStatsSource())
+
+def encode_cursor(name: str) -> str:
+    return base64.urlsafe_b64encode(name.encode()).decode()
+
+def decode_cursor(cursor: str) -> str:
+    try:
+        return base64.urlsafe_b64decode(cursor.encode()).decode()
+    except (ValueError, UnicodeDecodeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor.")
+
+# desired forwards per VM and the IP the current rules point at
+port_forward_table: Dict[str, List[Tuple[int, int]]] = {}
+port_forward_ips: Dict[str, str] = {}
+port_forward_lock = threading.Lock()
+
+def ensure_port_forward_chains() -> None:
+    """Create our chains and hook them into PREROUTING/FORWARD once."""
+    for table, chain, parent in (
+        ("nat", PORT_FORWARD_NAT_CHAIN, "PREROUTING"),
+        ("filter", PORT_FORWARD_FILTER_CHAIN, "FORWARD"),
+    ):
+        subprocess.run(["sudo", "iptables", "-t", table, "-N", chain], stderr=subprocess.DEVNULL)
+        exists = subprocess.run(
+            ["sudo", "iptables", "-t", table, "-C", parent, "-j", chain],
+            stderr=subprocess.DEVNULL
+        )
+        if exists.returncode != 0:
+            # insert at the top so libvirt's reject rules don't see the traffic first
+            subprocess.run(["sudo", "iptables", "-t", table, "-I", parent, "1", "-j", chain], check=True)
+
+def apply_port_forwards() -> None:
+    """Rewrite all port forward rules in one iptables-restore call."""
+    nat_rules = []
+    filter_rules = []
+    for vm_name, mappings in sorted(port_forward_table.items()):
+        vm_ip = port_forward_ips.get(vm_name)
+        if not vm_ip:
+            continue  # applied once the VM has an IP
+        for host_port, target_port in mappings:
+            # only traffic addressed to this node, guests talking to outside hosts on the same port must pass
+            nat_rules.append(
+                f"-A {PORT_FORWARD_NAT_CHAIN} -m addrtype --dst-type LOCAL -p tcp --dport {host_port}"
+                f" -j DNAT --to-destination {vm_ip}:{target_port}"
+            )
+            filter_rules.append(
+                f"-A {PORT_FORWARD_FILTER_CHAIN} -d {vm_ip} -p tcp --dport {target_port} -j ACCEPT"
+            )
+
+    # declaring a chain with --noflush empties it, everything else is left alone
+    rules = "\n".join(
+        ["*nat", f":{PORT_FORWARD_NAT_CHAIN} - [0:0]"] + nat_rules + ["COMMIT"]
+        + ["*filter", f":{PORT_FORWARD_FILTER_CHAIN} - [0:0]"] + filter_rules + ["COMMIT", ""]
+    )
+    ensure_port_forward_chains()
+    subprocess.run(
+        ["sudo", "iptables-restore", "--noflush"],
+        input=rules,
+        check=True,
+        stderr=subprocess.PIPE,
+        text=True
+    )
+    logger.info(f"Applied {len(nat_rules)} port forwards for {len(port_forward_ips)} VMs")
+
+def setup_port_forwarding(vm_name: str, vm_ip: Optional[str], port_mappings: List[Tuple[int, int]]) -> None:
+    """Record port forwards for a VM and apply them if it has an IP."""
+    with port_forward_lock:
+        mappings = dict(port_forward_table.get(vm_name, []))
+        for host_port, target_port in port_mappings:
+            mappings[host_port] = target_port
+        port_forward_table[vm_name] = sorted(mappings.items())
+        if vm_ip:
+            port_forward_ips[vm_name] = vm_ip
+        apply_port_forwards()
     for host_port, target_port in port_mappings:
+        logger.info(f"Port forwarding set: host:{host_port} -> {vm_ip or 'pending'}:{target_port} ({vm_name})")
+
+def get_vm_ips(vm_names: List[str]) -> Dict[str, str]:
+    """Look up the IPs of several VMs with a single ARP table read."""
+    arp_table = get_arp_table()
+    vm_ips = {}
+    for vm_name in vm_names:
+        mac_address = get_vm_mac(vm_name)
+        if mac_address and mac_address.lower() in arp_table:
+            vm_ips[vm_name] = arp_table[mac_address.lower()]
+    return vm_ips
+
+def get_defined_vms() -> Optional[set]:
+    """Names of all VMs defined on this node, None if virsh failed."""
+    result = subprocess.run(
+        ["sudo", "virsh", "list", "--all", "--name"],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        text=True
+    )
+    if result.returncode != 0:
+        logger.error(f"Error listing defined VMs: {result.stderr.strip()}")
+        return None
+    return {line.strip() for line in result.stdout.splitlines() if line.strip()}
+
+def find_missing_vms(vm_names: List[str]) -> List[str]:
+    """The VMs among vm_names that are no longer defined on this node."""
+    defined = get_defined_vms()
+    if defined is None:
+        return []
+    return [vm_name for vm_name in vm_names if vm_name not in defined]
+
+def release_missing_vm_ports(vm_names: List[str]) -> None:
+    """Tell the master to drop the forwards of deleted VMs, so a new VM with the same name starts clean."""
+    for vm_name in vm_names:
         try:
-            # Add a PREROUTING rule
-            subprocess.run(
-                [
-                    "sudo", "iptables", "-t", "nat", "-A", "PREROUTING",
-                    "-p", "tcp", "--dport", str(host_port),
-                    "-j", "DNAT", f"--to-destination", f"{vm_ip}:{target_port}"
-                ],
-                check=True
-            )
+            response = requests.post(f"{MASTER_BASE_URL}/release_ports", json={"vm_name": vm_name}, timeout=10)
+            if response.status_code not in (200, 404):
+                logger.error(f"Failed to release port forwards of deleted VM '{vm_name}': {response.text}")
+        except requests.RequestException as e:
+            logger.error(f"Error releasing port forwards of deleted VM '{vm_name}': {e}")
 
-            # Add a FORWARD rule
-            subprocess.run(
-                [
-                    "sudo", "iptables", "-A", "FORWARD",
-                    "-d", vm_ip, "-p", "tcp", "--dport", str(target_port),
-                    "-j", "ACCEPT"
-                ],
-                check=True
-            )
+def sync_port_forwards(forwards: List[PortForwardRecord]) -> List[str]:
+    """Replace all port forwards with the given records and apply them in bulk.
+
+    Records of VMs that no longer exist are skipped, their names are returned.
+    """
+    table: Dict[str, List[Tuple[int, int]]] = {}
+    for forward in forwards:
+        table.setdefault(forward.vm_name, []).append((forward.host_port, forward.target_port))
+    missing = find_missing_vms(list(table))
+    for vm_name in missing:
+        logger.warning(f"Skipping port forwards of VM '{vm_name}', it no longer exists.")
+        del table[vm_name]
+    vm_ips = get_vm_ips(list(table))
+    with port_forward_lock:
+        port_forward_table.clear()
+        port_forward_table.update(table)
+        port_forward_ips.clear()
+        port_forward_ips.update(vm_ips)
+        apply_port_forwards()
+    return missing
+
+def reconcile_port_forwards() -> bool:
+    """Re-apply port forwards if a VM got a new IP or was deleted. Returns True if rules changed."""
+    with port_forward_lock:
+        vm_names = list(port_forward_table)
+    if not vm_names:
+        return False
+    missing = find_missing_vms(vm_names)
+    vm_ips = get_vm_ips([vm_name for vm_name in vm_names if vm_name not in missing])
+    with port_forward_lock:
+        for vm_name in missing:
+            logger.warning(f"VM '{vm_name}' no longer exists, removing its port forwards")
+            port_forward_table.pop(vm_name, None)
+            port_forward_ips.pop(vm_name, None)
+        changed = {name: ip for name, ip in vm_ips.items() if port_forward_ips.get(name) != ip}
+        if not changed and not missing:
+            return False
+        for vm_name, vm_ip in changed.items():
+            logger.info(f"VM '{vm_name}' IP is now {vm_ip}, updating its port forwards")
+        port_forward_ips.update(changed)
+        apply_port_forwards()
+    # outside the lock, the master answers by syncing our forwards
+    release_missing_vm_ports(missing)
+    return True
+
+def fetch_port_forwards() -> List[PortForwardRecord]:
+    """Fetch the port forwards the master has recorded for this node."""
+    response = requests.get(
+        f"{MASTER_BASE_URL}/port_forwards",
+        params={"node": os.uname().nodename},
+        timeout=10
+    )
+    response.raise_for_status()
+    return [PortForwardRecord(**forward) for forward in response.json().get("forwards", [])]
 
-            logger.info(f"Port forwarding set: host:{host_port} -> {vm_ip}:{target_port}")
-        
-        except subprocess.CalledProcessError as e:
-            logger.error(f"Failed to set up port forwarding for {host_port} -> {vm_ip}:{target_port}: {e}")
 import socket
 
 def get_local_ip():
@@ -207,35 +893,178 @@ async def register_node():
     except Exception as e:
         logger.error(f"Error during node registration: {e}")
 
+async def restore_port_forwards() -> bool:
+    """Re-apply the master's recorded port forwards. Returns False if that failed."""
+    try:
+        forwards = await asyncio.to_thread(fetch_port_forwards)
+        missing = await asyncio.to_thread(sync_port_forwards, forwards)
+        logger.info(f"Restored {len(forwards)} port forwards from the master.")
+        await asyncio.to_thread(release_missing_vm_ports, missing)
+        return True
+    except Exception as e:
+        logger.error(f"Error restoring port forwards: {e}")
+        return False
+
+@app.on_event("startup")
+async def start_port_forwards():
+    """Restore port forwards and keep them on the right IPs."""
+    asyncio.create_task(reconcile_port_forwards_loop())
+
+async def reconcile_port_forwards_loop():
+    """Follow VM IP changes (e.g. VMs booting after a reboot) in the background.
+
+    After a power cycle the master may come up after us, so the restore is
+    retried every round until it works.
+    """
+    restored = await restore_port_forwards()
+    while True:
+        await asyncio.sleep(PORT_FORWARD_RECONCILE_INTERVAL)
+        if not restored:
+            restored = await restore_port_forwards()
+            continue
+        try:
+            await asyncio.to_thread(reconcile_port_forwards)
+        except Exception as e:
+            logger.error(f"Error reconciling port forwards: {e}")
+
+@app.on_event("startup")
+async def start_density_mode():
+    """Start adjusting guest balloons when density mode is on."""
+    if DENSITY_MODE:
+        asyncio.create_task(density_loop())
+
+async def refresh_density():
+    """Adjust balloons and refresh the memory summary reported to the master."""
+    try:
+        total_memory = get_system_resources()["total_memory"]
+        summary = await asyncio.to_thread(density_manager.step, total_memory)
+        logger.info(f"Memory density: {summary}")
+    except Exception as e:
+        logger.error(f"Error adjusting guest balloons: {e}")
+
+async def density_loop():
+    """Refresh the memory summary every DENSITY_INTERVAL."""
+    while True:
+        await refresh_density()
+        await asyncio.sleep(DENSITY_INTERVAL)
+
+@app.on_event("startup")
+async def calibrate_provisioning():
+    """Measure storage pool throughput so the provisioning queue can size its slots."""
+    for name, pool in STORAGE_POOLS.items():
+        if os.path.isdir(pool["path"]):
+            storage_pool_mbps[name] = await asyncio.to_thread(measure_disk_throughput, pool["path"])
+    measured = [mbps for mbps in storage_pool_mbps.values() if mbps]
+    # size for the slowest pool, image copies may land on any of them
+    provision_queue.disk_mbps = min(measured) if measured else None
+    logger.info(f"Storage pools: {get_storage_pools()}")
+    logger.info(f"Provisioning queue ready: {provision_queue.stats()}")
+
 @app.get("/status")
 async def status():
     """Provide status of this slave node."""
     try:
         resources = get_system_resources()
-        return {"status": "active", "resources": resources}
+        if DENSITY_MODE and density_manager.summary:
+            # lets the master place by what guests really use, not their configured memory.
+            # VMs still queued or being created are not in the summary yet, count them here
+            provisioning_memory = sum(request.memory for request in provisioning_vms.values())
+            resources["provisioning_memory"] = provisioning_memory
+            resources["allocatable_memory"] = max(0, density_manager.summary["allocatable_memory"] - provisioning_memory)
+            resources["effective_committed_memory"] = density_manager.summary["effective_committed_memory"]
+        return {
+            "status": "active",
+            "resources": resources,
+            "provisioning": provision_queue.stats(),
+            "storage": get_storage_pools(),
+            "density": density_manager.summary if DENSITY_MODE else None
+        }
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error fetching status: {e}")
 
+@app.get("/provision_queue")
+async def get_provision_queue():
+    """Report provisioning queue depth so the master can route elsewhere."""
+    return provision_queue.stats()
+
+@app.get("/storage")
+async def get_storage():
+    """Report storage pool capacity, usage and throughput."""
+    return {"pools": get_storage_pools()}
+
 @app.post("/create_vm")
 async def create_vm(vm_request: VMRequest):
     """Endpoint to create a new virtual machine."""
+    # Log the VM creation for debuggingggggg
+    logger.info(f"Received request to create VM: {vm_request.name} with OS: {vm_request.os}, Memory: {vm_request.memory}MB, VCPUs: {vm_request.vcpus}, Disk size: {vm_request.disk_size}GB, Priority: {vm_request.priority}")
+
+    os_name = vm_request.os.lower()
+    if os_name not in OS_IMAGES:
+        raise HTTPException(status_code=400, detail=f"Unsupported OS: {os_name}")
+
+    # Check if VM already exists so you don't mess up stuff
+    if vm_request.name in provisioning_vms:
+        raise HTTPException(status_code=400, detail=f"VM '{vm_request.name}' is already being created.")
+    if vm_exists(vm_request.name):
+        raise HTTPException(status_code=400, detail=f"VM '{vm_request.name}' already exists.")
+
+    # forwards set up here would skip the master's port index and its range check
+    if vm_request.port_forwards:
+        raise HTTPException(
+            status_code=400,
+            detail="Port forwards are allocated by the master, use its /create_vm or /port_forward."
+        )
+
+    validate_disk_options(vm_request)
+    # fail now rather than after waiting in the queue, space is reserved once a slot is granted
+    select_storage_pool(vm_request.disk_size, vm_request.storage_tier)
+
+    provisioning_vms[vm_request.name] = vm_request
     try:
-        # Log the VM creation for debuggingggggg
-        logger.info(f"Received request to create VM: {vm_request.name} with OS: {vm_request.os}, Memory: {vm_request.memory}MB, VCPUs: {vm_request.vcpus}, Disk size: {vm_request.disk_size}GB")
+        async with provision_queue.slot(vm_request.priority):
+            logger.info(f"Provisioning slot granted for VM '{vm_request.name}': {provision_queue.stats()}")
+            # the copy and virt-install are blocking so keep them off the event loop
+            storage_pool = await asyncio.to_thread(provision_vm, vm_request)
+
+        # the boot wait doesn't touch the disk much, so the slot is already free for the next VM
+        # Could be done better but i do not hav the time
+        logger.info(f"Waiting for VM '{vm_request.name}' to initialize...")
+        await asyncio.sleep(VM_BOOT_WAIT)
 
+        # get my ip again
+        vm_ip = await asyncio.to_thread(get_vm_ip, vm_request.name)
+        if not vm_ip:
+            raise HTTPException(status_code=500, detail="Failed to retrieve VM IP address.")
+
+        logger.info(f"VM '{vm_request.name}' IP address: {vm_ip}")
+        result = {
+            "message": f"VM '{vm_request.name}' created successfully.",
+            "ip_address": vm_ip,
+            "storage_pool": storage_pool,
+            "port_forwards": []
+        }
+        if DENSITY_MODE:
+            # count the new VM in the summary before it stops counting as in flight
+            await refresh_density()
+        return result
+    finally:
+        del provisioning_vms[vm_request.name]
+
+def provision_vm(vm_request: VMRequest) -> str:
+    """Copy the disk image and install the VM. Returns the storage pool used."""
+    pool = None
+    try:
         os_name = vm_request.os.lower()
-        if os_name not in OS_IMAGES:
-            raise HTTPException(status_code=400, detail=f"Unsupported OS: {os_name}")
-        
-        # Check if VM already exists so you don't mess up stuff
+        # it may have been created by someone else while we were queued
         if vm_exists(vm_request.name):
             raise HTTPException(status_code=400, detail=f"VM '{vm_request.name}' already exists.")
-        
         logger.info(f"VM '{vm_request.name}' does not exist. Proceeding with creation.")
 
         # disk paths
         prebuilt_disk_path = os.path.join(DISK_FOLDER, OS_IMAGES[os_name])
-        vm_folder = os.path.join(VM_DISKS_FOLDER, vm_request.name)
+        pool = reserve_storage_pool(vm_request.disk_size, vm_request.storage_tier)
+        logger.info(f"Placing VM '{vm_request.name}' disk on storage pool {pool['name']} ({pool['tier']}, {pool['free_gb']}GB free)")
+        vm_folder = os.path.join(pool["path"], vm_request.name)
         target_disk_path = os.path.join(vm_folder, OS_IMAGES[os_name])
 
         logger.info(f"Creating folder for VM disk at: {vm_folder}")
@@ -252,7 +1081,7 @@ async def create_vm(vm_request: VMRequest):
             "--name", vm_request.name,
             "--memory", str(vm_request.memory),
             "--vcpus", str(vm_request.vcpus),
-            "--disk", f"path={target_disk_path},size={vm_request.disk_size}",
+            "--disk", build_disk_arg(target_disk_path, vm_request),
             "--os-variant", "generic",
             "--network", "network=nat-network",
             "--graphics", "none",
@@ -265,28 +1094,12 @@ async def create_vm(vm_request: VMRequest):
         subprocess.run(command, check=True)
 
         logger.info(f"VM '{vm_request.name}' created successfully.")
-        
-        # Could be done better but i do not hav the time
-        logger.info(f"Waiting for VM '{vm_request.name}' to initialize...")
-        time.sleep(60)
+        vm_mac_cache.pop(vm_request.name, None)
+        return pool["name"]
+
+    except HTTPException:
+        raise
 
-        # get my ip again
-        vm_ip = get_vm_ip(vm_request.name)
-        if not vm_ip:
-            raise HTTPException(status_code=500, detail="Failed to retrieve VM IP address.")
-        
-        logger.info(f"VM '{vm_request.name}' IP address: {vm_ip}")
-        
-        if vm_request.port_forwards:
-            logger.info(f"Setting up port forwarding for VM '{vm_request.name}' with ports: {vm_request.port_forwards}")
-            setup_port_forwarding(vm_ip, vm_request.port_forwards)
-        
-        return {
-            "message": f"VM '{vm_request.name}' created successfully.",
-            "ip_address": vm_ip,
-            "port_forwards": vm_request.port_forwards or []
-        }
-    
     except subprocess.CalledProcessError as e:
         logger.error(f"Error during VM creation: {e.stderr.strip()}")
         raise HTTPException(status_code=500, detail=f"Error during VM creation: {e.stderr.strip()}")
@@ -295,6 +1108,10 @@ async def create_vm(vm_request: VMRequest):
         logger.error(f"Unexpected error during VM creation: {e}")
         raise HTTPException(status_code=500, detail=f"Unexpected error: {e}")
 
+    finally:
+        if pool:
+            release_storage_pool(pool, vm_request.disk_size)
+
 
 @app.post("/shutdown_vm")
 async def shutdown_vm(request: VMNameRequest):
@@ -331,11 +1148,10 @@ async def port_forward(port_request: PortForwardRequest):
         if not vm_exists(port_request.vm_name):
             raise HTTPException(status_code=404, detail=f"VM {port_request.vm_name} not found.")
 
+        # a stopped VM has no IP yet, its forwards are applied once it gets one
         vm_ip = get_vm_ip(port_request.vm_name)
-        if not vm_ip:
-            raise HTTPException(status_code=500, detail=f"Failed to retrieve IP address for VM {port_request.vm_name}.")
         try:
-            setup_port_forwarding(vm_ip, port_request.port_mappings)
+            await asyncio.to_thread(setup_port_forwarding, port_request.vm_name, vm_ip, port_request.port_mappings)
 
             logger.info(
                 f"Port forwarding set up: Host ports {[host for host, _ in port_request.port_mappings]} -> VM {port_request.vm_name} ports {[target for _, target in port_request.port_mappings]}"
@@ -357,27 +1173,61 @@ async def port_forward(port_request: PortForwardRequest):
         logger.error(f"Unexpected error: {e}")
         raise HTTPException(status_code=500, detail=f"An unexpected error occurred: {e}")
 
+@app.get("/port_forwards")
+async def get_port_forwards():
+    """List the port forwards this node has applied or is waiting to apply."""
+    with port_forward_lock:
+        return {
+            "forwards": [
+                {"vm_name": vm_name, "host_port": host_port, "target_port": target_port, "vm_ip": port_forward_ips.get(vm_name)}
+                for vm_name, mappings in sorted(port_forward_table.items())
+                for host_port, target_port in mappings
+            ]
+        }
+
+@app.post("/sync_port_forwards")
+async def sync_port_forwards_endpoint(sync_request: PortForwardSyncRequest):
+    """Replace this node's port forwards with the master's records in bulk."""
+    try:
+        await asyncio.to_thread(sync_port_forwards, sync_request.forwards)
+    except subprocess.CalledProcessError as e:
+        logger.error(f"Failed to sync port forwards: {e.stderr}")
+        raise HTTPException(status_code=500, detail=f"Failed to sync port forwards: {e.stderr}")
+    return {"message": f"Synced {len(sync_request.forwards)} port forwards."}
+
 @app.get("/vms")
-async def get_vms():
-    """Get a list of all virtual machines."""
+async def get_vms(
+    state: Optional[str] = None,
+    os_name: Optional[str] = Query(None, alias="os"),
+    name: Optional[str] = None,
+    cursor: Optional[str] = None,
+    limit: int = Query(VM_LIST_DEFAULT_LIMIT, ge=1, le=VM_LIST_MAX_LIMIT),
+    compact: bool = False
+):
+    """List virtual machines with state and resources, filtered and paginated."""
     try:
-        # listttt
-        result = subprocess.run(
-            ["sudo", "virsh", "list", "--all"],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True
-        )
-        if result.returncode != 0:
-            raise HTTPException(status_code=500, detail="Failed to fetch VM list.")
-        
-        vms = []
-        for line in result.stdout.splitlines():
-            columns = line.split()
-            if columns and len(columns) > 1:
-                vms.append(columns[1])
-                
-        return {"vms": vms}
+        vms = await asyncio.to_thread(get_vm_inventory, name)
     except subprocess.SubprocessError as e:
         logger.error(f"Error fetching VM list: {e}")
         raise HTTPException(status_code=500, detail=f"Error fetching VM list: {e}")
+
+    if state:
+        vms = [vm for vm in vms if vm["state"] == state]
+    if os_name:
+        vms = [vm for vm in vms if vm["os"] == os_name.lower()]
+    if name:
+        vms = [vm for vm in vms if vm["name"] == name]
+    if cursor:
+        after = decode_cursor(cursor)
+        vms = [vm for vm in vms if vm["name"] > after]
+
+    page = vms[:limit]
+    next_cursor = encode_cursor(page[-1]["name"]) if len(vms) > limit else None
+
+    if compact:
+        return {
+            "fields": VM_RECORD_FIELDS,
+            "rows": [[vm[field] for field in VM_RECORD_FIELDS] for vm in page],
+            "next_cursor": next_cursor
+        }
+    return {"vms": page, "next_cursor": next_cursor}
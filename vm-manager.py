@@ -1,13 +1,26 @@
 import click
-import requests
-import json
+
+# requests, json and concurrent.futures are imported where they are first used
+# so that short commands like --help don't pay for loading them
 
 MASTER_URL = "http://pi1.local:8000"
+DEFAULT_CONCURRENCY = 8
+DEFAULT_TIMEOUT = 600  # seconds
+CONNECT_TIMEOUT = 5
+# creating a VM can wait in a node's provisioning queue for as long as the master
+# lets it, so only the connect is bounded. Giving up early would report a failure
+# for a VM that still gets created.
+CREATE_VM_TIMEOUT = (CONNECT_TIMEOUT, None)
+
+_session = None
+_timeout = DEFAULT_TIMEOUT
 
 @click.group()
-def cli():
+@click.option('--timeout', default=DEFAULT_TIMEOUT, show_default=True, type=click.IntRange(1), help="Seconds to wait for each request to the master (create-vm waits until the master answers).")
+def cli(timeout):
     "A CLI tool to manage VMs via the master node."
-    pass
+    global _timeout
+    _timeout = timeout
 
 def print_success(message):
     "Print a success message in green."
@@ -21,13 +34,115 @@ def print_info(message):
     "Print an informational message in cyan."
     click.echo(click.style(message, fg="cyan"))
 
+class MasterError(Exception):
+    "Raised when the master can't be reached or answers with an error."
+
+def get_session(pool_size=DEFAULT_CONCURRENCY):
+    "Return the HTTP session shared by all requests, so connections get reused."
+    global _session
+    if _session is None:
+        import requests
+        from requests.adapters import HTTPAdapter
+        _session = requests.Session()
+        _session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+        _session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+    return _session
+
+def call_master(method, path, **kwargs):
+    "Send a request to the master and return the decoded JSON response."
+    import requests
+    kwargs.setdefault("timeout", (CONNECT_TIMEOUT, _timeout))
+    try:
+        response = get_session().request(method, f"{MASTER_URL}{path}", **kwargs)
+        response.raise_for_status()
+        return response.json()
+    except requests.HTTPError as e:
+        raise MasterError(f"{e} - {e.response.text}")
+    except requests.RequestException as e:
+        raise MasterError(str(e))
+
+def port_forward_payload(item):
+    "Build a /port_forward payload, letting the master pick the host port if none is given."
+    payload = {"vm_name": item["vm_name"], "port_mappings": [], "target_ports": []}
+    if item.get("host_port"):
+        payload["port_mappings"].append([item["host_port"], item["target_port"]])
+    else:
+        payload["target_ports"].append(item["target_port"])
+    return payload
+
+# Operations that can be run in bulk, each takes one item dict
+OPERATIONS = {
+    "create_vm": lambda item: call_master("POST", "/create_vm", json={k: v for k, v in item.items() if k != "op"}, timeout=CREATE_VM_TIMEOUT),
+    "start_vm": lambda item: call_master("POST", "/start_vm", json={"vm_name": item["vm_name"]}),
+    "shutdown_vm": lambda item: call_master("POST", "/shutdown_vm", json={"vm_name": item["vm_name"]}),
+    "port_forward": lambda item: call_master("POST", "/port_forward", json=port_forward_payload(item)),
+    "release_ports": lambda item: call_master("POST", "/release_ports", json={"vm_name": item["vm_name"], "host_ports": item.get("host_ports", [])}),
+}
+
+def run_operation(item):
+    "Run one operation and describe how it went."
+    outcome = {"op": item.get("op"), "vm_name": item.get("vm_name", item.get("name"))}
+    try:
+        operation = OPERATIONS[item["op"]]
+    except KeyError:
+        return dict(outcome, ok=False, error=f"Unknown operation: {item.get('op')}")
+    try:
+        return dict(outcome, ok=True, result=operation(item))
+    except MasterError as e:
+        return dict(outcome, ok=False, error=str(e))
+    except KeyError as e:
+        return dict(outcome, ok=False, error=f"Missing field: {e}")
+    except Exception as e:
+        # one bad item must not stop the results of the others from printing
+        return dict(outcome, ok=False, error=f"Unexpected error: {e}")
+
+def print_outcome(outcome, as_json):
+    "Print a single operation result as a JSON line or a coloured message."
+    if as_json:
+        import json
+        click.echo(json.dumps(outcome))
+    elif outcome["ok"]:
+        result = outcome["result"]
+        message = result.get("message", "Done.") if isinstance(result, dict) else "Done."
+        print_success(f"[{outcome['op']} {outcome['vm_name']}] {message}")
+    else:
+        print_error(f"[{outcome['op']} {outcome['vm_name']}] Error: {outcome['error']}")
+
+def run_operations(items, concurrency, as_json):
+    "Run operations concurrently over one session, printing results as they finish."
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+    get_session(pool_size=concurrency)
+    failures = 0
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        futures = [pool.submit(run_operation, item) for item in items]
+        for future in as_completed(futures):
+            outcome = future.result()
+            failures += not outcome["ok"]
+            print_outcome(outcome, as_json)
+    if failures:
+        raise SystemExit(1)
+
+def parse_operation(line):
+    "Parse a batch line, either a JSON object or '<op> <vm_name>'."
+    if line.startswith("{"):
+        import json
+        return json.loads(line)
+    op, vm_name = line.split(None, 1)
+    return {"op": op, "vm_name": vm_name.strip()}
+
+def batch_options(command):
+    "Add the --concurrency and --json options shared by bulk commands."
+    command = click.option('--json', 'as_json', is_flag=True, help="Print one JSON object per result for scripting.")(command)
+    command = click.option('--concurrency', default=DEFAULT_CONCURRENCY, show_default=True, type=click.IntRange(1, 64), help="Number of operations to run at once.")(command)
+    return command
+
 @click.command()
 @click.option('--name', required=True, help="Name of the VM.")
 @click.option('--memory', required=True, type=int, help="Memory for the VM in MB.")
 @click.option('--vcpus', required=True, type=int, help="Number of vCPUs for the VM.")
 @click.option('--disk-size', required=True, type=int, help="Disk size for the VM in GB.")
 @click.option('--os', required=True, type=str, help="Operating system for the VM (e.g., alpine, ubuntu, debian).")
-@click.option('--ports', multiple=True, type=int, help="Host ports to forward to the VM. Multiple values are allowed.")
+@click.option('--ports', multiple=True, type=int, help="VM ports to forward, the master picks the host ports. Multiple values are allowed.")
 def create_vm(name, memory, vcpus, disk_size, os, ports):
     "Create a new virtual machine."
     payload = {
@@ -39,9 +154,7 @@ def create_vm(name, memory, vcpus, disk_size, os, ports):
         "port_forwards": list(ports) if ports else []
     }
     try:
-        response = requests.post(f"{MASTER_URL}/create_vm", json=payload)
-        response.raise_for_status()
-        data = response.json()
+        data = call_master("POST", "/create_vm", json=payload, timeout=CREATE_VM_TIMEOUT)
 
         message = data.get("message", "VM created successfully.")
         ip_address = data.get("ip_address", "unknown")
@@ -56,107 +169,128 @@ def create_vm(name, memory, vcpus, disk_size, os, ports):
                 print_info(f"- {forward}")
         else:
             print_info("No port forwards configured.")
-    except requests.RequestException as e:
+        if data.get("port_forward_error"):
+            print_error(f"Port forwarding failed: {data['port_forward_error']}")
+    except MasterError as e:
         print_error(f"Error: {e}")
-        if hasattr(response, 'text'):
-            print_error(f"Response content: {response.text}")
 
 @click.command()
-@click.argument('vm_name')
-def shutdown_vm(vm_name):
-    "Shut down an existing VM."
-    try:
-        response = requests.post(f"{MASTER_URL}/shutdown_vm", json={"vm_name": vm_name})
-        response.raise_for_status()
-        print_success(f"VM '{vm_name}' shut down successfully.")
-    except requests.RequestException as e:
-        print_error(f"Error: {e}")
+@click.argument('vm_names', nargs=-1, required=True)
+@batch_options
+def shutdown_vm(vm_names, concurrency, as_json):
+    "Shut down one or more existing VMs."
+    run_operations([{"op": "shutdown_vm", "vm_name": vm_name} for vm_name in vm_names], concurrency, as_json)
 
 @click.command()
-@click.argument('vm_name')
-def start_vm(vm_name):
-    "Start an existing VM."
-    try:
-        response = requests.post(f"{MASTER_URL}/start_vm", json={"vm_name": vm_name})
-        response.raise_for_status()
-        print_success(f"VM '{vm_name}' started successfully.")
-    except requests.RequestException as e:
-        print_error(f"Error: {e}")
+@click.argument('vm_names', nargs=-1, required=True)
+@batch_options
+def start_vm(vm_names, concurrency, as_json):
+    "Start one or more existing VMs."
+    run_operations([{"op": "start_vm", "vm_name": vm_name} for vm_name in vm_names], concurrency, as_json)
 
 @click.command()
 @click.option('--vm-name', required=True, help="Name of the VM.")
-@click.option('--host-port', required=True, type=int, help="Host port to forward.")
+@click.option('--host-port', type=int, help="Host port to forward. Allocated by the master if left out.")
 @click.option('--target-port', required=True, type=int, help="Target port on the VM.")
 def port_forward(vm_name, host_port, target_port):
     "Set up port forwarding for a VM."
-    payload = {
-        "vm_name": vm_name,
-        "host_port": host_port,
-        "target_port": target_port
-    }
     try:
-        response = requests.post(f"{MASTER_URL}/port_forward", json=payload)
-        response.raise_for_status()
-        print_success(f"Port forwarding set up for VM '{vm_name}': {host_port} -> {target_port}.")
-    except requests.RequestException as e:
+        data = call_master("POST", "/port_forward", json=port_forward_payload(
+            {"vm_name": vm_name, "host_port": host_port, "target_port": target_port}
+        ))
+        for host, target in data.get("port_mappings", []):
+            print_success(f"Port forwarding set up for VM '{vm_name}': {host} -> {target}.")
+    except MasterError as e:
         print_error(f"Error: {e}")
 
+@click.command()
+@click.argument('operations_file', type=click.File('r'))
+@batch_options
+def batch(operations_file, concurrency, as_json):
+    """Run many operations from a file ('-' for stdin), one per line.
+
+    Lines are either '<op> <vm_name>' (e.g. 'start_vm vm-1') or a JSON object
+    with an "op" key and the operation's fields. Blank lines and lines starting
+    with '#' are skipped. Operations: create_vm, start_vm, shutdown_vm,
+    port_forward, release_ports.
+    """
+    items = []
+    for number, line in enumerate(operations_file, start=1):
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        try:
+            items.append(parse_operation(line))
+        except ValueError as e:
+            raise click.BadParameter(f"line {number}: {e}", param_hint="OPERATIONS_FILE")
+    run_operations(items, concurrency, as_json)
+
 
 @click.command()
 def cluster_status():
     "Fetch the status of the cluster."
     try:
-        response = requests.get(f"{MASTER_URL}/status")
-        response.raise_for_status()
-        data = response.json()
+        data = call_master("GET", "/status")
         for node, status in data.get('status', {}).items():
             if "error" in status:
                 print_error(f"Node {node}: {status['error']}")
             else:
                 print_info(f"Node {node}: {status}")
-    except requests.RequestException as e:
+    except MasterError as e:
         print_error(f"Error: {e}")
 
 @click.command()
 def list_nodes():
     "List all registered nodes."
     try:
-        response = requests.get(f"{MASTER_URL}/nodes")
-        response.raise_for_status()
-        nodes = response.json()
+        nodes = call_master("GET", "/nodes")
         if nodes:
             print_info("Registered nodes:")
             for node in nodes:
                 click.echo(f"- {node.get('node_name', 'unknown')} ({node.get('node_url', 'unknown')})")
         else:
             print_info("No nodes are currently registered.")
-    except requests.RequestException as e:
+    except MasterError as e:
         print_error(f"Error: {e}")
 @click.command()
-def list_vms():
+@click.option('--state', help="Only list VMs in this state (e.g. running, shutoff).")
+@click.option('--os', 'os_name', help="Only list VMs running this OS.")
+@click.option('--node', help="Only list VMs on this node.")
+def list_vms(state, os_name, node):
     """List all virtual machines across the cluster and the nodes they are running on."""
+    params = {"compact": "true"}
+    if state:
+        params["state"] = state
+    if os_name:
+        params["os"] = os_name
+    if node:
+        params["node"] = node
     try:
-        response = requests.get(f"{MASTER_URL}/list_vms")
-        response.raise_for_status()
-        data = response.json()
+        rows = []
+        while True:
+            data = call_master("GET", "/list_vms", params=params)
+            fields = data.get("fields", [])
+            rows.extend(dict(zip(fields, row)) for row in data.get("rows", []))
+            for node_name, error in data.get("errors", {}).items():
+                print_error(f"Node {node_name}: {error}")
+            if not data.get("next_cursor"):
+                break
+            params["cursor"] = data["next_cursor"]
 
-        vms_on_nodes = data.get("vms_on_nodes", {})
-        if not vms_on_nodes:
+        if not rows:
             print_info("No VMs found in the cluster.")
             return
-        
+
         print_info("List of VMs across the cluster:")
-        for node, vms in vms_on_nodes.items():
-            click.echo(f"- {node}:")
-            # workaround when i have time i need to fix
-            filtered_vms = [vm for vm in vms if vm != "Name"]
-            if filtered_vms:
-                for vm in filtered_vms:
-                    click.echo(f"  * {vm}")
-            else:
-                click.echo("  (No valid VMs found)")
+        click.echo(f"{'NODE':<16}{'NAME':<20}{'STATE':<10}{'VCPUS':>6}{'MEM(MB)':>9}{'DISK(GB)':>10}  {'IP':<16}{'OS':<8}UPTIME")
+        for vm in rows:
+            uptime = f"{vm['uptime'] // 3600}h{vm['uptime'] % 3600 // 60:02d}m" if vm.get("uptime") is not None else "-"
+            click.echo(
+                f"{vm['node']:<16}{vm['name']:<20}{vm['state']:<10}{vm['vcpus'] or '-':>6}"
+                f"{vm['memory'] or '-':>9}{vm['disk'] or '-':>10}  {vm['ip'] or '-':<16}{vm['os'] or '-':<8}{uptime}"
+            )
 
-    except requests.RequestException as e:
+    except MasterError as e:
         print_error(f"Error: {e}")
     except Exception as e:
         print_error(f"Unexpected error: {e}")
@@ -167,6 +301,7 @@ task_list = [
     shutdown_vm,
     start_vm,
     port_forward,
+    batch,
     cluster_status,
     list_nodes,
     list_vms